@@ -4,16 +4,20 @@ Parsing Collected NTP Logs
 Oisín Mc Laughlin - 22441106
 """
 from collections import defaultdict
+from contextlib import ExitStack
 from datetime import datetime
-import re
+from operator import itemgetter
 import os
 import csv
-import statistics
+import math
+import pickle
 import matplotlib.pyplot as plt
 import matplotlib.dates as mdates
 
 INPUT_FILE = "ntp-logs/ntplog.txt"
 OUTPUT_DIR = "parsed-ntp-logs"
+CACHE_FILE = "ntp_data_cache.pickle" # Parsed data cached in OUTPUT_DIR so re-runs can skip parsing
+WRITE_BUFFER_SIZE = 1 << 20 # 1 MB buffers for the CSV outputs to cut down on write syscalls
 
 SERVER_NAMES = {
     '140.203.204.77': 'Ireland',
@@ -25,37 +29,66 @@ SERVER_NAMES = {
     'ntp-b3.nict.go.': 'Japan'
 }
 
+# Tally codes ntpq prefixes to the remote column
+STATUS_CHARS = frozenset({'*', '+', '-', ' ', 'x', 'o', '#'})
 
-def parse_ntp_log(input_file):
+# Refids marking peers that are not yet usable (.STEP., .INIT., .RATE.)
+BAD_REFIDS = frozenset({'.STEP.', '.INIT.', '.RATE.'})
+
+# Seconds per unit for the suffix ntpq puts on the 'when' column
+WHEN_MULTIPLIERS = {'m': 60, 'h': 3600}
+
+
+def parse_timestamp(timestamp_str):
+    """
+    Parses a collection timestamp like "2024-06-01 12:00:00 UTC" by slicing the fixed-width fields,
+    which is much cheaper than datetime.strptime. The trailing zone must be UTC (or left off).
+    :param timestamp_str: Timestamp text from a "=== ... ===" line
+    :return: Naive datetime for the timestamp
+    """
+
+    # Check the fixed separators and zone so anything that isn't "YYYY-MM-DD HH:MM:SS UTC" still raises
+    if not (timestamp_str[4:5] == timestamp_str[7:8] == '-' and timestamp_str[10:11] == ' '
+            and timestamp_str[13:14] == timestamp_str[16:17] == ':' and timestamp_str[19:] in ('', ' UTC')):
+        raise ValueError(f"Unexpected timestamp format: {timestamp_str}")
+
+    return datetime(int(timestamp_str[0:4]), int(timestamp_str[5:7]), int(timestamp_str[8:10]),
+                    int(timestamp_str[11:13]), int(timestamp_str[14:16]), int(timestamp_str[17:19]))
+
+
+def parse_ntp_log(input_file, errors=None):
     """
     Parses the NTP log file and extracts relevant data points.
     :param input_file: Path to NTP log file
+    :param errors: Optional list that the bad timestamp header is appended to if parsing stops early
     :return: List of dictionaries containing parsed data points
     """
     data_rows = []
     current_timestamp = None
+    current_timestamp_str = None
 
     with open(input_file, 'r') as f:
-        for line in f:
-            line = line.strip()
+        # Read the whole log at once and split it in C instead of iterating the file per line
+        for line in f.read().splitlines():
+            # Split the line into parts based on whitespace (split() also strips the ends)
+            parts = line.split()
 
-            # Check for timestamp line
-            timestamp_match = re.match(r'=== (.+?) ===', line) # Match lines like "=== 2024-06-01 12:00:00 UTC ==="
-            if timestamp_match:
-                timestamp_str = timestamp_match.group(1) # Match the timestamp part
+            # Check for timestamp line like "=== 2024-06-01 12:00:00 UTC ==="
+            if len(parts) > 2 and parts[0] == '===' and parts[-1] == '===':
+                timestamp_str = ' '.join(parts[1:-1]) # Join the timestamp part back together
                 try:
-                    current_timestamp = datetime.strptime(timestamp_str, '%Y-%m-%d %H:%M:%S %Z') # Try parsing with timezone
+                    current_timestamp = parse_timestamp(timestamp_str)
+                    current_timestamp_str = current_timestamp.strftime('%Y-%m-%d %H:%M:%S') # Format once per snapshot
                 except ValueError:
                     print("Error failed to parse timestamp")
+                    if errors is not None:
+                        errors.append(timestamp_str)
                     break
 
-            # Skip header lines and empty lines
-            if not line or line.startswith('remote') or line.startswith('===') or line.startswith('='):
+            # Skip header lines, separator lines and empty lines
+            if not parts or parts[0] == 'remote' or parts[0].startswith('='):
                 continue
 
-            # Split the line into parts based on whitespace
-            parts = line.split()
-
             # Ensure we have enough parts to parse (at least 9 fields)
             if len(parts) < 9:
                 continue
@@ -63,7 +96,7 @@ def parse_ntp_log(input_file):
             # Extract the server status symbol if present
             remote = parts[0]
             status = ''
-            if remote and remote[0] in ['*', '+', '-', ' ', 'x', 'o', '#']:
+            if remote and remote[0] in STATUS_CHARS:
                 status = remote[0]
                 remote = remote[1:]
 
@@ -71,7 +104,7 @@ def parse_ntp_log(input_file):
             refid = parts[1]
 
             # Skip lines with .STEP., .INIT., or other error indicators
-            if refid in ['.STEP.', '.INIT.', '.RATE.']:
+            if refid in BAD_REFIDS:
                 continue
 
             try:
@@ -84,21 +117,20 @@ def parse_ntp_log(input_file):
                 offset = float(parts[8])
                 jitter = float(parts[9])
 
-                # Convert 'when' field
-                when_seconds = 0
-                if when != '-':
-                    if 'm' in when:
-                        when_seconds = int(when.replace('m', '')) * 60
-                    elif 'h' in when:
-                        when_seconds = int(when.replace('h', '')) * 3600
-                    else:
-                        try:
-                            when_seconds = int(when)
-                        except ValueError:
-                            when_seconds = 0
+                # Convert 'when' field using its unit suffix (e.g. '55', '3m', '2h' or '-')
+                multiplier = WHEN_MULTIPLIERS.get(when[-1])
+                if multiplier:
+                    when_seconds = int(when[:-1]) * multiplier
+                elif when == '-':
+                    when_seconds = 0
+                else:
+                    try:
+                        when_seconds = int(when)
+                    except ValueError:
+                        when_seconds = 0
 
                 data_rows.append({
-                    'timestamp': current_timestamp.strftime('%Y-%m-%d %H:%M:%S'),
+                    'timestamp': current_timestamp_str,
                     'timestamp_obj': current_timestamp,
                     'status': status,
                     'remote': remote,
@@ -120,150 +152,188 @@ def parse_ntp_log(input_file):
     return data_rows
 
 
-def write_main_csv(data_rows, output_dir):
+def update_running_stats(totals, value):
     """
-    Writes the parsed NTP data to a main CSV file.
-    :param data_rows: List of dictionaries containing parsed data points
-    :param output_dir: Directory to save the output CSV file
-    :return: Path to the created CSV file
+    Adds a single value to a running [count, mean, M2, min, max] accumulator using Welford's algorithm.
+    :param totals: Accumulator list to update in place
+    :param value: Value to add
+    :return: None
     """
 
-    output_file = os.path.join(output_dir, "ntp_data_all.csv")
+    totals[0] += 1
+    delta = value - totals[1]
+    totals[1] += delta / totals[0]
+    totals[2] += delta * (value - totals[1])
+    if value < totals[3]:
+        totals[3] = value
+    if value > totals[4]:
+        totals[4] = value
 
-    fieldnames = ['timestamp', 'status', 'remote', 'refid', 'stratum', 'type',
-                  'when_seconds', 'poll', 'reach', 'delay_ms', 'offset_ms', 'jitter_ms']
 
-    with open(output_file, 'w', newline='') as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-        writer.writeheader()
-        for row in data_rows:
-            row_copy = row.copy()
-            row_copy.pop('timestamp_obj', None)
-            writer.writerows([row_copy])
+def load_ntp_data(input_file, output_dir):
+    """
+    Loads the parsed NTP data from the cache if it was built from this exact log file by the current parser,
+    otherwise parses the log and refreshes the cache.
+    :param input_file: Path to NTP log file
+    :param output_dir: Directory holding the cache file
+    :return: List of dictionaries containing parsed data points
+    """
+
+    cache_file = os.path.join(output_dir, CACHE_FILE)
 
-    print(f"Created: {output_file}")
-    return output_file
+    # Identifies the parse a cache was built from, so any change to the log or to this parser invalidates it
+    input_path = os.path.realpath(input_file)
+    input_stat = os.stat(input_path)
+    parser_stat = os.stat(os.path.realpath(__file__))
+    cache_key = {
+        'input_file': input_path,
+        'mtime_ns': input_stat.st_mtime_ns,
+        'size': input_stat.st_size,
+        'parser_mtime_ns': parser_stat.st_mtime_ns,
+        'parser_size': parser_stat.st_size
+    }
 
+    try:
+        with open(cache_file, 'rb') as f:
+            cache = pickle.load(f)
+        if cache['key'] == cache_key:
+            data_rows = cache['data_rows']
+            print(f"Loaded {len(data_rows)} data points from cache: {cache_file}")
+            return data_rows
+    except Exception:
+        pass # Missing, unreadable or incompatible cache, fall back to parsing the log
+
+    errors = []
+    data_rows = parse_ntp_log(input_file, errors)
+
+    # Only cache a parse that reached the end of the log, never one that stopped on a bad timestamp
+    # Writing is best-effort like reading; the temp file + replace means a crash never leaves a truncated cache
+    if not errors:
+        temp_file = cache_file + '.tmp'
+        try:
+            with open(temp_file, 'wb') as f:
+                pickle.dump({'key': cache_key, 'data_rows': data_rows}, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_file, cache_file)
+        except OSError as e:
+            print(f"Warning: could not write cache {cache_file}: {e}")
+            try:
+                os.remove(temp_file)
+            except OSError:
+                pass
 
-def write_combined_csv(data_rows, output_dir):
+    return data_rows
+
+
+def write_csv_files(data_rows, output_dir):
     """
-    Writes a combined CSV file that includes the server location based on the remote server IP or hostname.
+    Writes the main CSV, the combined CSV with server locations and a CSV per server in a single pass
+    over the parsed data, accumulating running totals for the statistics at the same time.
     :param data_rows: List of dictionaries containing parsed data points
-    :param output_dir: Directory to save the output CSV file
-    :return: Path to the created CSV file
+    :param output_dir: Directory to save the output CSV files
+    :return: Dictionary mapping each server to running totals for its delay, offset and jitter
     """
 
-    output_file = os.path.join(output_dir, "ntp_data_with_locations.csv")
+    main_file = os.path.join(output_dir, "ntp_data_all.csv")
+    combined_file = os.path.join(output_dir, "ntp_data_with_locations.csv")
 
-    with open(output_file, 'w', newline='') as f:
-        fieldnames = ['timestamp', 'location', 'server', 'delay_ms', 'offset_ms', 'jitter_ms']
-        writer = csv.DictWriter(f, fieldnames=fieldnames)
-        writer.writeheader()
+    main_fieldnames = ['timestamp', 'status', 'remote', 'refid', 'stratum', 'type',
+                       'when_seconds', 'poll', 'reach', 'delay_ms', 'offset_ms', 'jitter_ms']
+    combined_fieldnames = ['timestamp', 'location', 'server', 'delay_ms', 'offset_ms', 'jitter_ms']
+    server_fieldnames = ['timestamp', 'delay_ms', 'offset_ms', 'jitter_ms']
+
+    get_main_fields = itemgetter(*main_fieldnames) # Pulls the columns out of a row as a tuple, skipping timestamp_obj
+    get_server_fields = itemgetter(*server_fieldnames)
+
+    # Running [count, mean, M2, min, max] for each metric of each server
+    server_totals = defaultdict(lambda: {
+        'delay': [0, 0.0, 0.0, float('inf'), float('-inf')],
+        'offset': [0, 0.0, 0.0, float('inf'), float('-inf')],
+        'jitter': [0, 0.0, 0.0, float('inf'), float('-inf')]
+    })
+
+    server_writers = {} # One open CSV writer per server, created the first time the server is seen
+    server_files = []
+
+    with ExitStack() as stack:
+        main_writer = csv.writer(stack.enter_context(open(main_file, 'w', newline='', buffering=WRITE_BUFFER_SIZE)))
+        main_writer.writerow(main_fieldnames)
+
+        combined_writer = csv.writer(stack.enter_context(open(combined_file, 'w', newline='', buffering=WRITE_BUFFER_SIZE)))
+        combined_writer.writerow(combined_fieldnames)
 
         for row in data_rows:
             server = row['remote']
-            location = SERVER_NAMES.get(server, server)
-            writer.writerow({
-                'timestamp': row['timestamp'],
-                'location': location,
-                'server': server,
-                'delay_ms': row['delay_ms'],
-                'offset_ms': row['offset_ms'],
-                'jitter_ms': row['jitter_ms']
-            })
+            delay = row['delay_ms']
+            offset = row['offset_ms']
+            jitter = row['jitter_ms']
+
+            main_writer.writerow(get_main_fields(row))
+            combined_writer.writerow((row['timestamp'], SERVER_NAMES.get(server, server), server,
+                                      delay, offset, jitter))
+
+            server_writer = server_writers.get(server)
+            if server_writer is None:
+                location_name = SERVER_NAMES.get(server, server.replace('.', '_'))
+                filename = os.path.join(output_dir, f"{location_name}.csv")
+
+                f = stack.enter_context(open(filename, 'w', newline='', buffering=WRITE_BUFFER_SIZE))
+                server_writer = server_writers[server] = csv.writer(f)
+                server_writer.writerow(server_fieldnames)
+                server_files.append(filename)
+
+            server_writer.writerow(get_server_fields(row))
+
+            totals = server_totals[server]
+            update_running_stats(totals['delay'], delay)
+            update_running_stats(totals['offset'], offset)
+            update_running_stats(totals['jitter'], jitter)
+
+    print(f"Created: {main_file}")
+    print(f"Created: {combined_file}")
+    for filename in server_files:
+        print(f"Created: {filename}")
 
-    print(f"Created: {output_file}")
-    return output_file
+    return server_totals
 
 
-def write_per_server_files(data_rows, output_dir):
+def summarise_running_stats(totals):
     """
-    Writes separate CSV files for each server, containing only the relevant data points for that server.
-    :param data_rows: List of dictionaries containing parsed data points
-    :param output_dir: Directory to save the output CSV files
-    :return: List of paths to the created CSV files
+    Turns a running [count, mean, M2, min, max] accumulator into summary statistics.
+    :param totals: Accumulator list built by update_running_stats
+    :return: Dictionary with min, max, mean and stdev
     """
 
-    servers_data = defaultdict(list) # Group data by server
-
-    for row in data_rows:
-        server = row['remote']
-        servers_data[server].append(row)
-
-    files_created = []
-
-    for server, data in servers_data.items():
-        location_name = SERVER_NAMES.get(server, server.replace('.', '_'))
-        filename = os.path.join(output_dir, f"{location_name}.csv")
-
-        with open(filename, 'w', newline='') as f:
-            fieldnames = ['timestamp', 'delay_ms', 'offset_ms', 'jitter_ms']
-            writer = csv.DictWriter(f, fieldnames=fieldnames)
-            writer.writeheader()
-
-            for row in data:
-                writer.writerow({
-                    'timestamp': row['timestamp'],
-                    'delay_ms': row['delay_ms'],
-                    'offset_ms': row['offset_ms'],
-                    'jitter_ms': row['jitter_ms']
-                })
-
-        files_created.append(filename)
-        print(f"Created: {filename}")
+    count, mean, m2, minimum, maximum = totals
+    stdev = math.sqrt(m2 / (count - 1)) if count > 1 else 0
 
-    return files_created
+    return {'min': minimum, 'max': maximum, 'mean': mean, 'stdev': stdev}
 
 
-def calculate_statistics(data_rows):
+def calculate_statistics(server_totals):
     """
     Calculates statistics (min, max, mean, stddev) for delay, offset, and jitter for each server.
-    :param data_rows: List of dictionaries containing parsed data points
+    :param server_totals: Dictionary mapping each server to running totals, as returned by write_csv_files
     :return: List of dictionaries containing statistics for each server
     """
 
-    servers_data = defaultdict(lambda: {'delay': [], 'offset': [], 'jitter': []})
-
-    for row in data_rows:
-        server = row['remote']
-        servers_data[server]['delay'].append(row['delay_ms'])
-        servers_data[server]['offset'].append(row['offset_ms'])
-        servers_data[server]['jitter'].append(row['jitter_ms'])
-
     stats = []
 
     print("\n" + "=" * 80)
     print("STATISTICS BY SERVER")
     print("=" * 80)
 
-    for server in sorted(servers_data.keys()):
-        data = servers_data[server]
+    for server in sorted(server_totals.keys()):
+        totals = server_totals[server]
         location = SERVER_NAMES.get(server, server)
+        data_points = totals['delay'][0]
 
-        delay_stats = {
-            'min': min(data['delay']),
-            'max': max(data['delay']),
-            'mean': statistics.mean(data['delay']),
-            'stdev': statistics.stdev(data['delay']) if len(data['delay']) > 1 else 0
-        }
-
-        offset_stats = {
-            'min': min(data['offset']),
-            'max': max(data['offset']),
-            'mean': statistics.mean(data['offset']),
-            'stdev': statistics.stdev(data['offset']) if len(data['offset']) > 1 else 0
-        }
-
-        jitter_stats = {
-            'min': min(data['jitter']),
-            'max': max(data['jitter']),
-            'mean': statistics.mean(data['jitter']),
-            'stdev': statistics.stdev(data['jitter']) if len(data['jitter']) > 1 else 0
-        }
+        delay_stats = summarise_running_stats(totals['delay'])
+        offset_stats = summarise_running_stats(totals['offset'])
+        jitter_stats = summarise_running_stats(totals['jitter'])
 
         print(f"\n{location} ({server})")
         print("-" * 40)
-        print(f"Data points: {len(data['delay'])}")
+        print(f"Data points: {data_points}")
         print("\nDelay (ms):")
         print(f"  Min:    {delay_stats['min']:.4f}")
         print(f"  Max:    {delay_stats['max']:.4f}")
@@ -278,7 +348,7 @@ def calculate_statistics(data_rows):
         stats.append({
             'Server': location,
             'IP_Hostname': server,
-            'Data_Points': len(data['delay']),
+            'Data_Points': data_points,
             'Delay_Min': delay_stats['min'],
             'Delay_Max': delay_stats['max'],
             'Delay_Mean': delay_stats['mean'],
@@ -329,9 +399,10 @@ def create_plots(data_rows, output_dir):
     # Group data by server
     servers = defaultdict(lambda: {'time': [], 'delay': [], 'jitter': []})
     for row in data_rows:
-        servers[row['remote']]['time'].append(row['timestamp_obj'])
-        servers[row['remote']]['delay'].append(row['delay_ms'])
-        servers[row['remote']]['jitter'].append(row['jitter_ms'])
+        data = servers[row['remote']]
+        data['time'].append(row['timestamp_obj'])
+        data['delay'].append(row['delay_ms'])
+        data['jitter'].append(row['jitter_ms'])
 
     # Plot delay
     plt.figure(figsize=(12, 6))
@@ -402,12 +473,10 @@ def create_plots(data_rows, output_dir):
 
 
 def main():
-    data_rows = parse_ntp_log(INPUT_FILE)
-    write_main_csv(data_rows, OUTPUT_DIR)
-    write_combined_csv(data_rows, OUTPUT_DIR)
-    write_per_server_files(data_rows, OUTPUT_DIR)
+    data_rows = load_ntp_data(INPUT_FILE, OUTPUT_DIR)
+    server_totals = write_csv_files(data_rows, OUTPUT_DIR)
 
-    stats = calculate_statistics(data_rows)
+    stats = calculate_statistics(server_totals)
     write_statistics_summary(stats, OUTPUT_DIR)
 
     create_plots(data_rows, OUTPUT_DIR)